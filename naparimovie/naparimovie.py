@@ -8,15 +8,21 @@ script.
 
 
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.animation import ArtistAnimation
 import napari
-from pyquaternion import Quaternion
-from matplotlib.animation import FuncAnimation
+from vispy.util.quaternion import Quaternion
 import imageio
 import copy
+import queue
+import threading
 
 from . import state_interpolations as si
-from .scriptcommands import Script 
+from .scriptcommands import Script
+
+#per-frame interpolated camera state, one contiguous row per frame
+_FRAME_DTYPE = np.dtype([('q', 'f8', (4,)), ('zoom', 'f8'), ('center', 'f8', (3,)), ('time', 'i8')])
 
 class Movie:
     
@@ -41,25 +47,22 @@ class Movie:
                 'zoom': float, camera zooming factor
                 'vis': list of booleans, visibility of layers
                 'time': int, time-point
-        interpolated_states: dict
-            dictionary defining interpolated states. Each element is a list of length N
-            frames. Keys are:
-                'rotate': list of pyquaternions
-                'translate': list of tuple defining camera center
-                'zoom': list of floats defining camera zoom
-                'vis': list of boolean lists defining layer visibility
-                'time': list of int defining time-point
+        _frame_states : 1D numpy structured array
+            interpolated camera state of length N frames, one row per frame,
+            with fields 'q' (quaternion coefficients w, x, y, z), 'zoom',
+            'center' and 'time'
+        _frame_vis : 2D numpy boolean array
+            interpolated layer visibility of shape (N frames, N layers)
         states_dict : list
-            list of dictionary defining napari viewer states for each frame. Same keys as key_frames
+            list of dictionary defining napari viewer states for each frame. Same keys as key_frames,
+            fields without a change at a given frame are set to None
         
         current_frame : int
             currently shown key frame
         implot : matplotlib Ax object
             reference to matplotlib image used for movie returned by imshow
-        anim : matplotlib FuncAnimation object
-            reference to animation object
-            
-        """        
+
+        """
         
         if myviewer is None:
             raise TypeError('You need to pass a napari viewer for the myviewer argument')
@@ -71,11 +74,31 @@ class Movie:
 
         self.current_frame = -1
         self.current_interpolframe = 0
+        #visibility and time-point of the previously shown frame, used to skip
+        #redundant napari property writes
+        self._prev_vis = None
+        self._prev_time = None
+        #set whenever the key-frames or inter_steps change, so that
+        #create_steps only recomputes the interpolation when needed
+        self._steps_stale = True
           
         #establish key bindings
         self.add_callback()
-                
-        
+
+
+    @property
+    def inter_steps(self):
+        """Number of steps to interpolate between key frames. Assigning a new
+        value invalidates the cached interpolation"""
+
+        return self._inter_steps
+
+    @inter_steps.setter
+    def inter_steps(self, value):
+        self._inter_steps = value
+        self._steps_stale = True
+
+
     def add_callback(self):
         """Bind keys"""
                 
@@ -98,12 +121,14 @@ class Movie:
             description of state
         """
         
-        current_state = copy.deepcopy(self.myviewer.window.qt_viewer.view.camera.get_state())
-        time = self.myviewer.dims.point[0] if len(self.myviewer.dims.point)==4 else []
+        #no need to deepcopy the whole camera state, the extracted fields are
+        #immutable except for the quaternion which is copied shallowly
+        current_state = self.myviewer.window.qt_viewer.view.camera.get_state()
+        time = self.myviewer.dims.point[0] if len(self.myviewer.dims.point)==4 else None
         new_state = {'frame': self.current_frame,
-                     'rotate': current_state['_quaternion'],
-                     'translate': current_state['center'],
-                     'zoom': current_state['scale_factor'],
+                     'rotate': copy.copy(current_state['_quaternion']),
+                     'translate': tuple(current_state['center']),
+                     'zoom': float(current_state['scale_factor']),
                      'vis': [x.visible for x in self.myviewer.layers],
                     'time': time}
         
@@ -116,6 +141,7 @@ class Movie:
         new_state['frame']+=1
         self.key_frames.insert(self.current_frame+1, new_state)
         self.current_frame += 1
+        self._steps_stale = True
         
         
     def replace_keyframe_callback(self, viewer):
@@ -123,7 +149,8 @@ class Movie:
         
         new_state = self.get_new_state()
         self.key_frames[self.current_frame] = new_state
-        
+
+        self._steps_stale = True
         self.create_steps()
         
             
@@ -131,9 +158,10 @@ class Movie:
         """Delete current key-frame"""
         
         self.key_frames.pop(self.current_frame)
-            
+
         self.current_frame = (self.current_frame -1)%len(self.key_frames)
         self.set_to_keyframe(self.current_frame)
+        self._steps_stale = True
         self.create_steps()
             
     def key_adv_frame(self,viewer):
@@ -159,23 +187,26 @@ class Movie:
         """
         
         self.current_frame = frame
-        
-        #set camera state
-        new_state = copy.deepcopy(self.myviewer.window.qt_viewer.view.camera.get_state())
-        if self.key_frames[frame]['rotate']: 
-            new_state['_quaternion'] = self.key_frames[frame]['rotate']
-        if self.key_frames[frame]['translate']: new_state['center'] = self.key_frames[frame]['translate']
-        if self.key_frames[frame]['zoom']: new_state['scale_factor'] = self.key_frames[frame]['zoom']
-        
+        key_frame = self.key_frames[frame]
+
+        #set camera state, passing only the fields stored in the key-frame
+        #rather than deep-copying the complete camera state graph
+        new_state = {}
+        if key_frame['rotate'] is not None:
+            new_state['_quaternion'] = key_frame['rotate']
+        if key_frame['translate'] is not None: new_state['center'] = key_frame['translate']
+        if key_frame['zoom'] is not None: new_state['scale_factor'] = key_frame['zoom']
+
         #set time if 4D
         if len(self.myviewer.dims.point)==4:
-            if type(self.key_frames[frame]['time']) is not list:
-                self.myviewer.dims.set_point(0,self.key_frames[frame]['time'])
-        
+            if key_frame['time'] is not None:
+                self.myviewer.dims.set_point(0,key_frame['time'])
+
         #set visibility of layers
-        for j in range(len(self.myviewer.layers)):
-            if self.key_frames[frame]['vis']: self.myviewer.layers[j].visible = self.key_frames[frame]['vis'][j]
-        
+        if key_frame['vis'] is not None:
+            for j in range(len(self.myviewer.layers)):
+                self.myviewer.layers[j].visible = key_frame['vis'][j]
+
         #update state
         self.myviewer.window.qt_viewer.view.camera.set_state(new_state)
         self.myviewer.window.qt_viewer.view.camera.view_changed()
@@ -191,13 +222,12 @@ class Movie:
         else:
             inter_steps = self.inter_steps
         
-        empty = {'frame': [],'rotate': [],'translate': [],'zoom': [],'vis': [], 'time': []}
         states_dict = []
         for ind, x in enumerate(self.key_frames):
             states_dict.append(x)
             if ind<len(self.key_frames)-1:
                 for y in range(inter_steps[ind]):
-                    states_dict.append(copy.deepcopy(empty))
+                    states_dict.append({'frame': None,'rotate': None,'translate': None,'zoom': None,'vis': None, 'time': None})
         for ind, x in enumerate(states_dict):
             x['frame'] = ind
         self.states_dict = states_dict
@@ -220,40 +250,102 @@ class Movie:
         script.make_keyframes()
         self.key_frames = script.key_frames
         self.inter_steps = [self.key_frames[x+1]['frame']-self.key_frames[x]['frame']-1 for x in range(len(self.key_frames)-1)]
+        self._steps_stale = True
 
     def create_steps(self):
-        """Interpolate states between key-frames"""
-        
+        """Interpolate states between key-frames. The interpolation is only
+        recomputed when key-frames have changed since the last call"""
+
+        if not self._steps_stale:
+            return
+
         self.create_state_dict()
-        self.interpolated_states = si.interpolate(self.states_dict)
-        
+        interpolated = si.interpolate(self.states_dict)
+
+        #pack the per-frame camera state into a single structured array so that
+        #one row read fetches all fields of a frame
+        frame_states = np.zeros(len(self.states_dict), dtype = _FRAME_DTYPE)
+        frame_states['q'] = interpolated['rotate']
+        frame_states['zoom'] = interpolated['zoom']
+        frame_states['center'] = interpolated['translate']
+        if interpolated['time'] is not None:
+            frame_states['time'] = interpolated['time']
+        self._frame_states = frame_states
+        self._frame_vis = interpolated['vis']
+
+        self._prev_vis = None
+        self._prev_time = None
+        #viewer properties that are stable during a rendering, cached to avoid
+        #repeated attribute chain walks into napari per frame
+        self._is_4d = len(self.myviewer.dims.point) == 4
+        self._n_layers = len(self.myviewer.layers)
+        self._steps_stale = False
+
     def key_interpolframe(self, viewer):
         """Progress through interpolated frames"""
-        
+
         self.create_steps()
-            
+        #the viewer may have been modified between key presses, e.g. by a
+        #manual layer toggle or set_to_keyframe, so the skip caches cannot be
+        #trusted here
+        self._prev_vis = None
+        self._prev_time = None
+        self._is_4d = len(self.myviewer.dims.point) == 4
+        self._n_layers = len(self.myviewer.layers)
+
         new_frame = (self.current_interpolframe+1)%len(self.states_dict)
         self.update_napari_state(new_frame)
         self.current_interpolframe = new_frame
 
                
+    def _capture_frame(self):
+        """Grab the current view as an RGBA array. For batch export the vispy
+        canvas is rendered directly, which skips the Qt event processing done
+        by napari's screenshot()
+
+        Returns
+        -------
+        image : 3D numpy
+            snapshot of the current view
+        """
+
+        try:
+            return self.myviewer.window.qt_viewer.canvas.render()
+        except AttributeError:
+            return self.myviewer.screenshot()
+
+    def iter_frames(self):
+        """Iterate over all interpolated states and yield the corresponding
+        snapshots one by one, so that callers can stream them to disk without
+        accumulating the full movie in memory
+
+        Returns
+        -------
+        frames : generator of 3D numpy
+            snapshot for each interpolated state
+        """
+
+        self.create_steps()
+        #the viewer may have been modified interactively since the last rendering
+        self._prev_vis = None
+        self._prev_time = None
+        self._is_4d = len(self.myviewer.dims.point) == 4
+        self._n_layers = len(self.myviewer.layers)
+        for i in range(len(self.states_dict)):
+            self.update_napari_state(i)
+            yield self._capture_frame()
+
+
     def collect_images(self):
         """Collect images corresponding to all interpolated states
-        
+
         Returns
         -------
         image_stack : 3D numpy
             stack of all snapshots
         """
-        
-        images = []
-        self.create_steps()
-        for i in range(len(self.states_dict)):
-            
-            self.update_napari_state(i)
-            images.append(self.myviewer.screenshot())
-          
-        image_stack = np.stack(images,axis = 0)
+
+        image_stack = np.stack(list(self.iter_frames()),axis = 0)
         return image_stack
     
     
@@ -266,19 +358,27 @@ class Movie:
             frame to visualize
         """
 
-        new_state = copy.deepcopy(self.myviewer.window.qt_viewer.view.camera.get_state())
-        
-        new_state['_quaternion'] = new_state['_quaternion'].create_from_axis_angle(
-            self.interpolated_states['rotate'][frame].angle, *self.interpolated_states['rotate'][frame].axis)
-        new_state['scale_factor'] = self.interpolated_states['zoom'][frame]
-        #new_state['fov'] = self.all_fov[frame]
-        new_state['center'] = self.interpolated_states['translate'][frame]
-        
-        if len(self.myviewer.dims.point)==4:
-                self.myviewer.dims.set_point(0,self.interpolated_states['time'][frame])
-        
-        for j in range(len(self.myviewer.layers)):
-                self.myviewer.layers[j].visible = self.interpolated_states['vis'][frame][j]
+        row = self._frame_states[frame]
+
+        #only pass the fields that actually change, set_state leaves the rest
+        #of the camera state untouched
+        new_state = {'_quaternion': Quaternion(*row['q']),
+                     'scale_factor': float(row['zoom']),
+                     'center': tuple(row['center'])}
+
+        if self._is_4d:
+            time = row['time']
+            if time != self._prev_time:
+                self.myviewer.dims.set_point(0,time)
+                self._prev_time = time
+
+        #only touch layers whose visibility actually changes, to avoid firing
+        #Qt signals for unchanged values
+        vis_row = self._frame_vis[frame]
+        for j in range(self._n_layers):
+            if self._prev_vis is None or self._prev_vis[j] != vis_row[j]:
+                self.myviewer.layers[j].visible = vis_row[j]
+        self._prev_vis = vis_row
             
         self.myviewer.window.qt_viewer.view.camera.set_state(new_state)
         self.myviewer.window.qt_viewer.view.camera.view_changed()
@@ -293,41 +393,24 @@ class Movie:
         width = float(sizes[1])
 
         factor = 3
-        fig = plt.figure()
+        #bare Figure avoids registering with pyplot's global state and the
+        #interactive backend, which slows down saving
+        fig = Figure()
+        FigureCanvasAgg(fig)
         fig.set_size_inches(factor*width/height, factor, forward=False)
-        ax = plt.Axes(fig, [0., 0., 1., 1.])
+        ax = fig.add_axes([0., 0., 1., 1.])
         ax.set_axis_off()
-        fig.add_axes(ax)
-        
+
         self.fig = fig
         self.ax = ax
-                
-        self.implot = plt.imshow(newim,animated=True)
 
-    def movie_init(self):
-        """init function for matplotlib FuncAnimation"""
-        
-        newim = self.myviewer.screenshot()
-        self.implot.set_data(newim)
-        return self.implot
+        self.implot = ax.imshow(newim,animated=True)
 
-    def update(self, frame):
-        """Update function matplotlib FuncAnimation 
-        
-        Parameters
-        -------
-        frame : int
-            frame to visualize
-        """
-        
-        self.update_napari_state(frame)
-        newim = self.myviewer.screenshot()
-        self.implot.set_data(newim)
-        return self.implot
+    def make_movie_matplotlib(self, name = 'movie.mp4', resolution = 600, fps = 20):
+        """Create a movie through a matplotlib ArtistAnimation. Slower than
+        make_movie since every frame goes through a matplotlib figure, kept
+        for cases where an animation object is wanted
 
-    def make_movie(self, name = 'movie.mp4', resolution = 600, fps = 20):
-        """Create a movie based on key-frames selected in napari
-        
         Parameters
         -------
         name : str
@@ -337,17 +420,79 @@ class Movie:
         fps : int
             frames per second
         """
-        
-        #creat all states
+
         self.create_steps()
         #create movie frame
         self.create_movie_frame()
-        #animate
-        self.anim = FuncAnimation(self.fig, self.update, frames=np.arange(len(self.states_dict)),
-                        init_func=self.movie_init, blit=False)
-        plt.show()
-        
+        #all frames are known ahead of time, so materialize the artists up-front
+        #instead of re-rendering through a per-frame callback
+        artists = [[self.ax.imshow(im, animated=True)] for im in self.iter_frames()]
+        self.anim = ArtistAnimation(self.fig, artists, interval=1000/fps, blit=True)
+
         self.anim.save(name,dpi=resolution,fps = fps)
+
+    def make_movie(self, name = 'movie.mp4', resolution = 600, fps = 20):
+        """Create a movie based on key-frames selected in napari
+
+        Parameters
+        -------
+        name : str
+            name to use for saving the movie (can also be a path)
+        resolution: int
+            unused, kept for backward compatibility. Frames are written
+            at the native canvas size
+        fps : int
+            frames per second
+        """
+
+        #write the snapshots directly to the encoder, skipping matplotlib entirely.
+        #Encoding runs on a background thread fed through a bounded queue, so the
+        #next snapshot is captured while the previous frame is being encoded
+        writer = imageio.get_writer(name, fps = fps, macro_block_size = 1)
+        #with a ring of 4 buffers and 2 queued frames at most, a slot is never
+        #overwritten before the encoder is done with it
+        frame_queue = queue.Queue(maxsize = 2)
+        #an exception raised while encoding is stored here and re-raised on
+        #the main thread once the capture loop has stopped
+        encode_error = []
+
+        def encode():
+            while True:
+                im = frame_queue.get()
+                if im is None:
+                    break
+                if encode_error:
+                    #keep draining the queue after a failure so that the
+                    #producer never blocks on a full queue
+                    continue
+                try:
+                    writer.append_data(im)
+                except Exception as e:
+                    encode_error.append(e)
+
+        encoder = threading.Thread(target = encode)
+        encoder.start()
+        try:
+            #copy the snapshots into a small ring of preallocated buffers so that
+            #the same four arrays are reused over the whole movie instead of
+            #keeping one fresh allocation per queued frame
+            buffers = None
+            for i, im in enumerate(self.iter_frames()):
+                if encode_error:
+                    break
+                if buffers is None:
+                    buffers = [np.empty_like(im) for x in range(4)]
+                buf = buffers[i%4]
+                np.copyto(buf, im)
+                frame_queue.put(buf)
+        finally:
+            #always stop the encoder thread and close the writer, also when
+            #capturing a snapshot fails
+            frame_queue.put(None)
+            encoder.join()
+            writer.close()
+        if encode_error:
+            raise encode_error[0]
         
         
     def make_gif(self, name = 'movie.gif'):
@@ -359,10 +504,12 @@ class Movie:
             name to use for saving the movie (can also be a path)
         """
         
-        #create the image stack with all snapshots
-        stack = self.collect_images()
-        
-        imageio.mimsave(name, [stack[i,:,:,:] for i in range(stack.shape[0])])
+        #stream the snapshots to the writer one by one instead of
+        #materializing the full stack in memory
+        writer = imageio.get_writer(name, mode = 'I')
+        for im in self.iter_frames():
+            writer.append_data(im)
+        writer.close()
 
 
         
@@ -6,10 +6,110 @@ containing intstructions for creating key-frames programmatically
 # License: BSD3 License
 
 import copy, re
+from functools import lru_cache
+from math import ceil, cos, sin, pi
 import numpy as np
-from pyquaternion import Quaternion as pyQuaternion
 from vispy.util.quaternion import Quaternion
 
+#patterns compiled once at import time instead of on every call. The patterns
+#are anchored on their prefix (no leading .*) and matched with search, which
+#avoids the dot-star scan and backtracking of the previous findall calls
+_RE_TO_FRAME = re.compile(r'to frame \d+\n', re.ASCII)
+_RE_END = re.compile(r'(At frame |to frame )(\d+)', re.ASCII)
+_RE_FROM = re.compile(r'From frame (\d+)', re.ASCII)
+_RE_TO = re.compile(r'to frame (\d+)', re.ASCII)
+_RE_AT = re.compile(r'At frame (\d+)', re.ASCII)
+_RE_ROT_ANGLE = re.compile(r'rotate by (\d+)', re.ASCII)
+_RE_LAYER = re.compile(r'make layer (\d+)', re.ASCII)
+_RE_TIME = re.compile(r'by (\-*\d+)', re.ASCII)
+
+@lru_cache(maxsize = None)
+def _axis_angle_quat(angle, ax, ay, az):
+    """Build a vispy quaternion from a rotation angle and axis with plain
+    math calls, avoiding the classmethod dispatch of create_from_axis_angle.
+    Scripts typically repeat the same rotation many times (e.g. split large
+    rotations), so the quaternions are cached per (angle, axis) pair
+
+    Parameters
+    ----------
+    angle : float
+        rotation angle in degrees
+    ax, ay, az : int
+        rotation axis
+
+    Returns
+    -------
+    vispy quaternion
+        quaternion describing the rotation
+    """
+
+    half_angle = angle*pi/360
+    sin_half = sin(half_angle)
+    return Quaternion(cos(half_angle), sin_half*ax, sin_half*ay, sin_half*az)
+
+def _qmul(q1, q2):
+    """Multiply two quaternions directly on their coefficients, skipping the
+    operator dispatch of the vispy __mul__
+
+    Parameters
+    ----------
+    q1, q2 : vispy quaternions
+        quaternions to multiply
+
+    Returns
+    -------
+    vispy quaternion
+        Hamilton product q1*q2
+    """
+
+    return Quaternion(q1.w*q2.w - q1.x*q2.x - q1.y*q2.y - q1.z*q2.z,
+                      q1.w*q2.x + q1.x*q2.w + q1.y*q2.z - q1.z*q2.y,
+                      q1.w*q2.y + q1.y*q2.w + q1.z*q2.x - q1.x*q2.z,
+                      q1.w*q2.z + q1.z*q2.w + q1.x*q2.y - q1.y*q2.x)
+
+def _parse_rotate(command):
+    """Parse a "rotate by x degrees around (x,y,z)" command"""
+
+    angle = int(_RE_ROT_ANGLE.search(command).group(1))
+    axis = [int(v) for v in command[command.index('(')+1:command.index(')')].split(',')]
+
+    #split large rotations into just enough parts to keep each one below
+    #180 degrees, so the quaternion interpolation does not take a shortcut
+    n_parts = max(1, ceil(angle/170))
+    if n_parts > 1:
+        new_q = _axis_angle_quat(angle/n_parts, axis[0], axis[1], axis[2])
+        return [('rotate', new_q)]*n_parts
+    new_q = _axis_angle_quat(angle, axis[0], axis[1], axis[2])
+    return ('rotate', new_q)
+
+def _parse_translate(command):
+    """Parse a "translate by (x,y,z)" command"""
+
+    translate = tuple(int(v) for v in command[command.index('(')+1:command.index(')')].split(','))
+    return ('translate', translate)
+
+def _parse_zoom(command):
+    """Parse a "zoom by a factor of x" command"""
+
+    factor = float(command.split('factor of ')[1].split()[0])
+    return ('zoom', factor)
+
+def _parse_make(command):
+    """Parse a "make layer x (in)visible" command"""
+
+    layer = int(_RE_LAYER.search(command).group(1))
+    return ('vis', layer, command.split()[-1] != 'invisible')
+
+def _parse_time(command):
+    """Parse a "shift time by x" command"""
+
+    time_shift = int(_RE_TIME.search(command).group(1))
+    return ('time', time_shift)
+
+#operation keyword appearing in the command mapped to its parser
+_COMMAND_PARSERS = {'rotate': _parse_rotate, 'translate': _parse_translate,
+                    'zoom': _parse_zoom, 'make': _parse_make, 'time': _parse_time}
+
 class Script:
     
     def __init__(self, path_to_script = None):
@@ -46,6 +146,7 @@ class Script:
                 'zoom': float, camera zooming factor
                 'vis': list of booleans, visibility of layers
                 'time': int, time-point
+            fields without a change at a given frame are set to None
         key_frames: list
             same as states_dict but only elements containing a change are conserved
             
@@ -55,32 +156,37 @@ class Script:
             raise TypeError('You need to pass a string with a path to a script')
         else:
             self.path_to_script = path_to_script
-            
-        #instantiate Quaternion object
-        self.q = Quaternion()
 
-        
-        
-        
+
+
+
     def read_script(self):
         """Read the script and create a list with groups of 
         commands belonging to a given unit"""
         
-        #read all lines
-        commands = []
+        #read all lines. splitlines on the full text is cheaper than the
+        #per-line buffered reads done by readlines
         with open(self.path_to_script) as f:
-            commands = f.readlines()
+            commands = f.read().splitlines(True)
 
-        #group commands belonging together e.g. those belonging to 
-        #and From frame ... statement
+        #group commands belonging together e.g. those belonging to
+        #and From frame ... statement. The maximal frame is tracked in the
+        #same pass instead of re-scanning the whole file afterwards
         command_series = []
+        end = 0
         line = 0
         while line<len(commands):
             main_line = commands[line]
             line+=1
             if main_line[0]=='#':
                 continue
-            if len(re.findall('.*to frame \d+(\n)', main_line))==1:
+            #frame numbers only appear on "At frame"/"From frame" headers, so
+            #comments and continuation lines are never scanned for the end frame
+            end_match = _RE_END.search(main_line)
+            if end_match:
+                end = max(end, int(end_match.group(2)))
+            #cheap substring test first, the regex only runs on candidate lines
+            if 'to frame' in main_line and _RE_TO_FRAME.search(main_line):
                 temp_lines = []
                 while (commands[line][0]=='-'):
                     temp_lines.append(commands[line])
@@ -91,9 +197,6 @@ class Script:
             else:
                 command_series.append([main_line,[main_line]])
 
-        end = [re.findall('(At frame |to frame )(\d+).*',x) for x in commands]
-        end = np.max([int(x[0][1]) for x in end if x])
-        
         self.command_series = command_series
         self.end = end
         
@@ -108,11 +211,11 @@ class Script:
             
             #get start and end frames. For "At frame..." statements end == start
             if c[0].split()[0] == 'From':
-                start = int(re.findall('From frame (\d+) to*', c[0])[0])
-                end = int(re.findall('to frame (\d+) *', c[0])[0])
+                start = int(_RE_FROM.search(c[0]).group(1))
+                end = int(_RE_TO.search(c[0]).group(1))
             else:
-                start = int(re.findall('At frame (\d+).*', c[0])[0])
-                end = int(re.findall('At frame (\d+).*', c[0])[0])
+                start = int(_RE_AT.search(c[0]).group(1))
+                end = start
             
             #For each group of statements parse the commands
             for c2 in c[1]:
@@ -120,131 +223,147 @@ class Script:
                 #if parsing returns a list, it means that the operation has been split into parts
                 #mainly to handle large rotations
                 if type(parsed) is list:
-                    interm_steps = np.linspace(start,end,len(parsed)+1).astype(int)
-                    for i in range(len(interm_steps)-1):
-                        command_list.append([interm_steps[i], interm_steps[i+1], parsed[i]])
+                    n_parts = len(parsed)
+                    span = end-start
+                    interm_steps = [start + (span*i)//n_parts for i in range(n_parts+1)]
+                    for part_start, part_end, part in zip(interm_steps, interm_steps[1:], parsed):
+                        command_list.append([part_start, part_end, part])
                 else:
                     command_list.append([start, end, parsed])                        
         
         #sort commands by time
-        command_list = np.array(command_list)
-        command_list = command_list[np.argsort(command_list[:,0]),:]
-        
+        command_list.sort(key=lambda x: x[0])
+
         #create list of dictionaries
         command_list = [{'start': x[0], 'end': x[1], 'operation': x[2][0], 'params': x[2][1:]} for x in command_list]
         self.command_list = command_list
         
     def parse_command(self, command):
         """given a command line, parse the content
-        
+
         Returns
         -------
         result : tuple
             tuple with the type of operation and the corresponding parameters
             e.g. ('zoom', 2)
         """
-        
-        #chcek operation type
-        mod_type = re.findall('.*(rotate|translate|zoom|make|time).*',command)[0]
-        
-        #for each operation type recover necessary parameters
-        if mod_type == 'rotate':
-            angle = int(re.findall('.*rotate by (\d+).*', command)[0])
-            axis = list(map(int,re.findall('.*around \((\d+)\,(\d+)\,(\d+).*', command)[0]))
-
-            #if the rotation angle is large split it into 3 to ensure the rotation is accomplished fully
-            if angle >= 180:
-                new_q = self.q.create_from_axis_angle(angle/3*2*np.pi/360, axis[0], axis[1], axis[2], degrees=False)
-                result = [(mod_type, new_q),(mod_type, new_q),(mod_type, new_q)]
-            else:
-                new_q = self.q.create_from_axis_angle(angle*2*np.pi/360, axis[0], axis[1], axis[2], degrees=False)
-                result = (mod_type, new_q)
-
-        elif mod_type == 'zoom':
-            factor = float(re.findall('.*factor of (\d*\.*\d+).*', command)[0])
-            result = (mod_type, factor)
-
-        elif mod_type == 'translate':
-            translate = np.array(list(map(int,re.findall('.*by \((\-*\d+)\,(\-*\d+)\,(\-*\d+).*', command)[0])))
-            result = (mod_type, translate)
-
-        elif mod_type == 'make':
-            layer = int(re.findall('.*make layer (\d+).*', command)[0])
-            vis_status = command.split()[-1]
-            if vis_status == 'invisible':
-                result = ('vis', layer, False)
-            else:
-                result = ('vis', layer, True)
-                
-        elif mod_type == 'time':
-            time_shift = int(re.findall('.*by (\-*\d+).*', command)[0])
-            result = (mod_type, time_shift)
-        return result
+
+        #dispatch on the operation keyword with plain substring tests, one
+        #dedicated parser per operation type
+        for keyword, parser in _COMMAND_PARSERS.items():
+            if keyword in command:
+                return parser(command)
+        raise ValueError('Unknown command: ' + command)
     
     def create_frame_commandlist(self, movie):
         """Go through the list of operations and create for each frame a dictionary
         with modifications to be operated. Only frames with an operation are filled,
         the others are interpolated later"""
         
-        states_dict = [dict(zip(('frame','rotate','translate','zoom', 'vis','time'), (a, [],[],[],[],[]))) for a in np.arange(self.end+1)]
+        #None marks fields without a change, avoiding one empty list allocation
+        #per field and frame
+        states_dict = [{'frame': a, 'rotate': None, 'translate': None, 'zoom': None,
+                        'vis': None, 'time': None} for a in range(self.end+1)]
 
-        #initialize state with current view. This first point can be adjusted by using 
+        #initialize state with current view. This first point can be adjusted by using
         #a series of "At frame 0... " commands
-        current_state = copy.deepcopy(movie.myviewer.window.qt_viewer.view.camera.get_state())
-        states_dict[0]['rotate'] = current_state['_quaternion']
-        states_dict[0]['zoom'] = current_state['scale_factor']
-        states_dict[0]['translate'] = current_state['center']
+        current_state = movie.myviewer.window.qt_viewer.view.camera.get_state()
+        states_dict[0]['rotate'] = copy.copy(current_state['_quaternion'])
+        states_dict[0]['zoom'] = float(current_state['scale_factor'])
+        states_dict[0]['translate'] = tuple(current_state['center'])
         states_dict[0]['vis'] = [x.visible for x in movie.myviewer.layers]
         if len(movie.myviewer.dims.point)==4:
             states_dict[0]['time'] = movie.myviewer.dims.point[0]
 
-            
-        #fille the states_dict at the start/end positions by compounding operations over frame containing changes
-        old_state = copy.deepcopy(states_dict[0])
+
+        #fille the states_dict at the start/end positions by compounding operations
+        #over frame containing changes. Quaternions, tuples and scalars are treated
+        #as immutable so no copies are needed, only the vis list is duplicated
+        old_state = dict(states_dict[0])
+
+        #one handler per operation type, dispatched through a single dict
+        #lookup instead of a linear if/elif chain
+        def apply_rotate(c):
+            states_dict[c['start']]['rotate'] = old_state['rotate']
+            states_dict[c['end']]['rotate'] = _qmul(old_state['rotate'], c['params'][0])
+            old_state['rotate'] = states_dict[c['end']]['rotate']
+
+        def apply_vis(c):
+            new_vis = list(old_state['vis'])
+            new_vis[c['params'][0]] = c['params'][1]
+            states_dict[c['start']]['vis'] = old_state['vis']
+            states_dict[c['end']]['vis'] = new_vis
+            old_state['vis'] = new_vis
+
+        #rotations and visibility switches stay per-command since they act on
+        #objects, the numeric fields are propagated in bulk below
+        handlers = {'rotate': apply_rotate, 'vis': apply_vis}
         for c in self.command_list:
+            if c['operation'] in handlers:
+                handlers[c['operation']](c)
 
-            if c['operation'] == 'rotate':
-                states_dict[c['start']]['rotate'] = copy.deepcopy(old_state['rotate'])
-                states_dict[c['end']]['rotate'] = copy.deepcopy(old_state['rotate']*c['params'][0])
-                old_state['rotate'] = copy.deepcopy(states_dict[c['end']]['rotate'])
-
-            elif c['operation'] == 'translate':
-                states_dict[c['start']]['translate'] = copy.deepcopy(old_state['translate'])
-                states_dict[c['end']]['translate'] = copy.deepcopy(tuple(np.array(old_state['translate']) + c['params'][0]))
-                old_state['translate'] = copy.deepcopy(states_dict[c['end']]['translate'])
-
-            elif c['operation'] == 'zoom':
-                states_dict[c['start']]['zoom'] = copy.deepcopy(old_state['zoom'])
-                states_dict[c['end']]['zoom'] = copy.deepcopy(old_state['zoom'] * c['params'][0])
-                old_state['zoom'] = copy.deepcopy(states_dict[c['end']]['zoom'])
-
-            elif c['operation'] == 'vis':
-                states_dict[c['start']]['vis'] = copy.deepcopy(old_state['vis'])
-                states_dict[c['end']]['vis'] = copy.deepcopy(old_state['vis'])
-                states_dict[c['end']]['vis'][c['params'][0]] = c['params'][1]
-                old_state['vis'] = copy.deepcopy(states_dict[c['end']]['vis'])
-                
-            elif c['operation'] == 'time':
-                states_dict[c['start']]['time'] = copy.deepcopy(old_state['time'])
-                states_dict[c['end']]['time'] = copy.deepcopy(old_state['time'] + c['params'][0])
-                old_state['time'] = copy.deepcopy(states_dict[c['end']]['time'])
+        self._propagate_numeric_ops(states_dict, old_state)
 
         old_state['frame'] = states_dict[-1]['frame']
-        states_dict[-1] = copy.deepcopy(old_state)
+        states_dict[-1] = dict(old_state)
         
         self.states_dict = states_dict
-        
-        
+
+
+    def _propagate_numeric_ops(self, states_dict, old_state):
+        """Propagate zoom, translate and time operations. Each field only
+        depends on its own commands, so the compounded values are computed
+        with one cumulative numpy operation per field and then scattered to
+        the start/end frames
+
+        Parameters
+        ----------
+        states_dict : list of dicts
+            per-frame state dictionaries being filled
+        old_state : dict
+            running state, updated in place with the final values
+        """
+
+        zoom_cmds = [c for c in self.command_list if c['operation'] == 'zoom']
+        if zoom_cmds:
+            zooms = old_state['zoom']*np.cumprod([c['params'][0] for c in zoom_cmds])
+            previous = old_state['zoom']
+            for c, value in zip(zoom_cmds, zooms):
+                states_dict[c['start']]['zoom'] = previous
+                states_dict[c['end']]['zoom'] = value
+                previous = value
+            old_state['zoom'] = previous
+
+        trans_cmds = [c for c in self.command_list if c['operation'] == 'translate']
+        if trans_cmds:
+            centers = np.array(old_state['translate']) + np.cumsum([c['params'][0] for c in trans_cmds], axis = 0)
+            previous = old_state['translate']
+            for c, value in zip(trans_cmds, centers):
+                states_dict[c['start']]['translate'] = previous
+                states_dict[c['end']]['translate'] = tuple(value)
+                previous = states_dict[c['end']]['translate']
+            old_state['translate'] = previous
+
+        time_cmds = [c for c in self.command_list if c['operation'] == 'time']
+        if time_cmds:
+            times = old_state['time'] + np.cumsum([c['params'][0] for c in time_cmds])
+            previous = old_state['time']
+            for c, value in zip(time_cmds, times):
+                states_dict[c['start']]['time'] = previous
+                states_dict[c['end']]['time'] = value
+                previous = value
+            old_state['time'] = previous
+
+
     def make_keyframes(self):
         """In the states_dict list of dictionaries, conserve only elements 
         where change is happening
         """
 
-        props = ['rotate', 'translate','zoom','vis','time']
-        states_copy = copy.deepcopy(self.states_dict)
-        key_frames = [y for y in states_copy if np.any([y[x] for x in props])]
-        
-        self.key_frames = key_frames
+        #the key-frames can share the state dictionaries, no copy is needed,
+        #and the builtin any short-circuits on the first property that is set
+        props = ('rotate', 'translate','zoom','vis','time')
+        self.key_frames = [y for y in self.states_dict if any(y[x] is not None for x in props)]
 
         
        
\ No newline at end of file
@@ -5,176 +5,286 @@ between successive napari views states
 # Author: Guillaume Witz, Science IT Support, Bern University, 2019
 # License: BSD3 License
 
-import copy, re
 import numpy as np
-from pyquaternion import Quaternion as pyQuaternion
-from vispy.util.quaternion import Quaternion
+
+#numba is optional, the NumPy implementations are used when it is missing
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 def interpolate(states_dict):
     """Calculate interpolations for all states
-        
+
     Returns
     -------
     interpolated: dict
-        dictionary defining interpolated states. Each element is a list of length N
+        dictionary defining interpolated states. Each element is of length N
         frames. Keys are:
-            'rotate': list of pyquaternions
-            'translate': list of tuple defining camera center
+            'rotate': 2D numpy array of quaternion coefficients (w, x, y, z)
+            'translate': 2D numpy array of shape (N frames, 3) defining camera center
             'zoom': list of floats defining camera zoom
-            'vis': list of boolean lists defining layer visibility
+            'vis': 2D numpy boolean array defining layer visibility
             'time': list of int defining time-point
     """
-    
-    
+
+
+    keys = _extract_keyframes(states_dict)
+    n_frames = len(states_dict)
+
     interpolated = {}
-    interpolated['rotate'] = interpolate_rotation(states_dict)
-    interpolated['translate'] = interpolate_translation(states_dict)
-    interpolated['zoom'] = interpolate_scales(states_dict)
-    interpolated['vis'] = interpolate_visibility(states_dict)
-    interpolated['time'] = interpolate_time(states_dict)
-    
+    interpolated['rotate'] = interpolate_rotation(*keys['rotate'])
+    interpolated['translate'] = interpolate_translation(*keys['translate'], n_frames)
+    interpolated['zoom'] = interpolate_scales(*keys['zoom'], n_frames)
+    interpolated['vis'] = interpolate_visibility(*keys['vis'])
+    interpolated['time'] = interpolate_time(*keys['time'], n_frames)
+
     return interpolated
-    
-    
-def interpolate_rotation(states_dict):
-    """Interpolate rotation states as quaternions
-    
+
+
+def _extract_keyframes(states_dict):
+    """Gather the key-frame entries of each field into parallel arrays in a
+    single pass over the list of state dictionaries
+
     Parameters
     ----------
     states_dict: list of dicts
         list of states dictionaries generated by scriptcommands.create_frame_commandlist()
         and naparimovie.create_state_dict()
-    
+
     Returns
     -------
-    all_states: list of pyquaternions
-        list of rotation states of length N frames
-            
+    keys: dict
+        dictionary with keys 'rotate', 'translate', 'zoom', 'vis' and 'time'.
+        Each element is a (frames, values) pair of numpy arrays containing the
+        frames where the field is set and the corresponding values
+
     """
-    
-    frames_rot = [[x['frame'], x['rotate']] for x in states_dict if x['rotate']]
-    
-    all_states = {x: [] for x in range(frames_rot[0][0],frames_rot[-1][0]+1)}
-
-    for i in range(len(frames_rot)-1):
-        q0 = pyQuaternion(frames_rot[i][1].w, frames_rot[i][1].x,
-                          frames_rot[i][1].y,frames_rot[i][1].z)
-        q1 = pyQuaternion(frames_rot[i+1][1].w, frames_rot[i+1][1].x,
-                          frames_rot[i+1][1].y,frames_rot[i+1][1].z)
-
-        num_frames = frames_rot[i+1][0]-frames_rot[i][0]-1
-        for ind, q in enumerate(pyQuaternion.intermediates(q0, q1,num_frames, include_endpoints=True)):
-            all_states[frames_rot[i][0]+ind] =  q
-    all_states = [all_states[x] for x in all_states.keys()]
+
+    rot_frames, rot_quats = [], []
+    trans_frames, trans_centers = [], []
+    zoom_frames, zoom_scales = [], []
+    vis_frames, vis_rows = [], []
+    time_frames, time_points = [], []
+
+    for x in states_dict:
+        frame = x['frame']
+        if x['rotate'] is not None:
+            q = x['rotate']
+            rot_frames.append(frame)
+            rot_quats.append([q.w, q.x, q.y, q.z])
+        if x['translate'] is not None:
+            trans_frames.append(frame)
+            trans_centers.append(x['translate'])
+        if x['zoom'] is not None:
+            zoom_frames.append(frame)
+            zoom_scales.append(x['zoom'])
+        if x['vis'] is not None:
+            vis_frames.append(frame)
+            vis_rows.append(x['vis'])
+        if x['time'] is not None:
+            time_frames.append(frame)
+            time_points.append(x['time'])
+
+    return {'rotate': (np.array(rot_frames), np.array(rot_quats)),
+            'translate': (np.array(trans_frames), np.array(trans_centers, dtype = float)),
+            'zoom': (np.array(zoom_frames), np.array(zoom_scales)),
+            'vis': (np.array(vis_frames), np.array(vis_rows, dtype = bool)),
+            'time': (np.array(time_frames), np.array(time_points))}
+
+
+def _slerp_segment(q0, q1, t):
+    """Spherical linear interpolation between two quaternions
+
+    Parameters
+    ----------
+    q0, q1: 1D numpy arrays
+        quaternion coefficients (w, x, y, z)
+    t: 1D numpy array
+        interpolation positions between 0 and 1
+
+    Returns
+    -------
+    2D numpy array
+        interpolated quaternion coefficients, one row per element of t
+
+    """
+
+    dot = np.dot(q0, q1)
+    #take the short way around the sphere
+    if dot < 0:
+        q1 = -q1
+        dot = -dot
+    #for nearly aligned quaternions fall back to normalized linear interpolation
+    if dot > 0.9995:
+        interm = q0 + t[:, None]*(q1 - q0)
+        return interm/np.linalg.norm(interm, axis=1)[:, None]
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    s0 = np.sin((1-t)*theta)/sin_theta
+    s1 = np.sin(t*theta)/sin_theta
+    return s0[:, None]*q0 + s1[:, None]*q1
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _slerp_segment(q0, q1, t):
+        """Numba version of _slerp_segment, replaces the NumPy one above"""
+
+        dot = q0[0]*q1[0] + q0[1]*q1[1] + q0[2]*q1[2] + q0[3]*q1[3]
+        sign = 1.0
+        if dot < 0:
+            sign = -1.0
+            dot = -dot
+        out = np.empty((t.shape[0], 4))
+        if dot > 0.9995:
+            for i in range(t.shape[0]):
+                norm = 0.0
+                for c in range(4):
+                    out[i, c] = q0[c] + t[i]*(sign*q1[c] - q0[c])
+                    norm += out[i, c]**2
+                norm = np.sqrt(norm)
+                for c in range(4):
+                    out[i, c] /= norm
+        else:
+            theta = np.arccos(dot)
+            sin_theta = np.sin(theta)
+            for i in range(t.shape[0]):
+                s0 = np.sin((1.0-t[i])*theta)/sin_theta
+                s1 = np.sin(t[i]*theta)/sin_theta
+                for c in range(4):
+                    out[i, c] = s0*q0[c] + s1*sign*q1[c]
+        return out
+
+
+def interpolate_rotation(frames, quats):
+    """Interpolate rotation states as quaternions
+
+    Parameters
+    ----------
+    frames: 1D numpy array
+        frames at which a rotation key-frame is set
+    quats: 2D numpy array
+        quaternion coefficients (w, x, y, z), one row per key-frame
+
+    Returns
+    -------
+    all_states: 2D numpy array
+        quaternion coefficients (w, x, y, z) of length N frames, one row per frame
+
+    """
+
+    if len(frames) == 1:
+        return quats
+
+    all_states = np.empty((frames[-1]-frames[0]+1, 4))
+    for i in range(len(frames)-1):
+        num_frames = frames[i+1]-frames[i]
+        t = np.arange(num_frames+1)/num_frames
+        all_states[frames[i]-frames[0]:frames[i+1]-frames[0]+1] = _slerp_segment(quats[i], quats[i+1], t)
     return all_states
 
 
-def interpolate_translation(states_dict):
+def interpolate_translation(frames, centers, n_frames):
     """Interpolate camera center views
-    
+
     Parameters
     ----------
-    states_dict: list of dicts
-        list of states dictionaries generated by scriptcommands.create_frame_commandlist()
-        and naparimovie.create_state_dict()
-    
+    frames: 1D numpy array
+        frames at which a camera center key-frame is set
+    centers: 2D numpy array
+        camera center coordinates, one row per key-frame
+    n_frames: int
+        total number of frames
+
     Returns
     -------
-    center_interp: list of tuples
-        list of tuples defining camera center view of length N frames
-            
+    center_interp: 2D numpy array
+        array of shape (N frames, 3) defining camera center view, one row
+        per frame
+
     """
-    
-    frames_trans = np.array([np.concatenate(([x['frame']], np.array(x['translate']))) 
-                         for x in states_dict if x['translate']])
-    all_frames = np.array([x['frame'] for x in states_dict])
 
-    center_interp = [np.interp(x=all_frames,xp = frames_trans[:,0], 
-                                   fp = frames_trans[:,c+1]) for c in range(3)]
-    center_interp = np.stack(center_interp,axis = 1)
-    center_interp = [tuple(x) for x in center_interp]
+    if len(frames) == 1:
+        return np.repeat(centers, n_frames, axis = 0)
+
+    #linearly interpolate all three axes at once instead of looping over
+    #per-axis np.interp calls
+    all_frames = np.arange(n_frames)
+    idx = np.clip(np.searchsorted(frames, all_frames, side = 'right')-1, 0, len(frames)-2)
+    frac = np.clip((all_frames-frames[idx])/(frames[idx+1]-frames[idx]), 0, 1)
+    center_interp = centers[idx] + frac[:,None]*(centers[idx+1]-centers[idx])
 
     return center_interp
 
 
-def interpolate_scales(states_dict):
+def interpolate_scales(frames, scales, n_frames):
     """Interpolate camera zoom states
-    
+
     Parameters
     ----------
-    states_dict: list of dicts
-        list of states dictionaries generated by scriptcommands.create_frame_commandlist()
-        and naparimovie.create_state_dict()
-    
+    frames: 1D numpy array
+        frames at which a camera zoom key-frame is set
+    scales: 1D numpy array
+        camera zoom factors, one per key-frame
+    n_frames: int
+        total number of frames
+
     Returns
     -------
     scales_interp: list of floats
         list of floats defining camera zoom of length N frames
-            
+
     """
-    
-    frames = [x['frame'] for x in states_dict]
-    all_scales = np.array([[x['frame'], x['zoom']] for x in states_dict if x['zoom']])
-    scales_interp = np.interp(x=frames,xp = all_scales[:,0], fp = all_scales[:,1])
-    
+
+    scales_interp = np.interp(x=np.arange(n_frames),xp = frames, fp = scales)
+
     return scales_interp
 
-def interpolate_visibility(states_dict):
+def interpolate_visibility(frames, vis_rows):
     """Interpolate visibility states of layers
-    
+
     Parameters
     ----------
-    states_dict: list of dicts
-        list of states dictionaries generated by scriptcommands.create_frame_commandlist()
-        and naparimovie.create_state_dict()
-    
+    frames: 1D numpy array
+        frames at which a visibility key-frame is set
+    vis_rows: 2D numpy boolean array
+        layer visibility, one row per key-frame
+
     Returns
     -------
-    frame_make: list of lists
-        list of lists defining layer visibility of length N frames. e.g. [[True, False],[True, False]....]
-        for 2 layers
-            
+    frame_make: 2D numpy boolean array
+        array of shape (N frames, N layers) defining layer visibility, one
+        contiguous row per frame
+
     """
-    
-    frame_make = np.array([np.concatenate(([x['frame']], x['vis'])) for x in states_dict if x['vis']])
-    frame_make = np.concatenate([[frame_make[x,1::] for i in range(frame_make[x,0],frame_make[x+1,0])] 
-                for x in range(len(frame_make)-1)]+[[frame_make[-1,1::]]]).astype(bool)
+
+    #visibility is piecewise constant: repeat each key-frame row until the next one
+    frame_make = np.concatenate([np.repeat(vis_rows[:-1], np.diff(frames), axis=0),
+                                 vis_rows[-1:]])
     return frame_make
 
-def interpolate_time(states_dict):
+def interpolate_time(frames, time_points, n_frames):
     """Interpolate time frames for 4D data
-    
+
     Parameters
     ----------
-    states_dict: list of dicts
-        list of states dictionaries generated by scriptcommands.create_frame_commandlist()
-        and naparimovie.create_state_dict()
-    
+    frames: 1D numpy array
+        frames at which a time key-frame is set
+    time_points: 1D numpy array
+        time-points, one per key-frame
+    n_frames: int
+        total number of frames
+
     Returns
     -------
     time_interp: list of ints
         list of time points of length N frames.
-            
-    """
-    
-    frames = [x['frame'] for x in states_dict]
-    all_scales = np.array([[x['frame'], x['time']] for x in states_dict if type(x['time']) is not list])
-    time_interp = None
-    if len(all_scales)>0:
-        time_interp = np.interp(x=frames,xp = all_scales[:,0], fp = all_scales[:,1]).astype(int)
-    
-    return time_interp
-
-
-
-
-
-
-
-
-
-
-
 
+    """
 
+    time_interp = None
+    if len(frames)>0:
+        time_interp = np.interp(x=np.arange(n_frames),xp = frames, fp = time_points).astype(int)
 
+    return time_interp